@@ -4,5 +4,11 @@ from .game import (
     play_flip7
 )
 
+from . import compare
 from . import db
-from . import plot
\ No newline at end of file
+from . import plot
+from . import policy
+from . import rare
+from . import replay
+from . import stats
+from . import telemetry
\ No newline at end of file
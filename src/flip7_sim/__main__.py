@@ -1,4 +1,5 @@
 from argparse import ArgumentParser
+from pathlib import Path
 import logging
 logging.basicConfig(
     filename = "flip7-sim.log",
@@ -8,7 +9,16 @@ logging.basicConfig(
 )
 
 from flip7_sim import play_flip7
-from flip7_sim.plot import plot_game, PLOT_DIR
+from flip7_sim.plot import plot_game, export_plots, select_game_ids, PLOT_DIR
+from flip7_sim.db import sql_connect_to_db, DB_PATH
+from flip7_sim.stats import play_aggregate
+from flip7_sim import workqueue
+from flip7_sim.compare import compare_styles
+from flip7_sim.game import ALL_PLAYER_STYLES, STYLES_BY_CODE
+from flip7_sim.policy import benchmark_draw_again, compile_style, load_table
+from flip7_sim.rare import estimate_rare_event, no_tilt, EVENT_TILTS, DEFENSIVE_FRACTION
+from flip7_sim.replay import check_replays
+from flip7_sim.telemetry import Telemetry, monitor, TELEMETRY_PATH
 
 def main():
 
@@ -22,13 +32,149 @@ def main():
 
     parser.add_argument("-p", "--print-logs", action="store_true")
 
+    parser.add_argument("-d", "--decks", type=int, help="number of decks in the shoe (default: enough for the table)")
+
     parser.add_argument("-s", "--save-figure", action="store_true")
 
     parser.add_argument("--suppress-figure", action="store_true")
 
+    parser.add_argument("-g", "--num-games", default=1, type=int)
+
+    parser.add_argument("--aggregate", action="store_true", help="only keep per style/seat aggregates and a reservoir of full traces")
+
+    parser.add_argument("--reservoir", default=10, type=int, help="number of full game traces kept in --aggregate mode")
+
+    parser.add_argument("--replay-only", action="store_true", help="store each game as a seed replay record instead of every turn")
+
+    parser.add_argument("--telemetry", action="store_true", help="publish live counters for `flip7 monitor`")
+
+    parser.add_argument("--telemetry-path", default=TELEMETRY_PATH, help="telemetry file shared with `flip7 monitor`")
+
+
+    subparsers = parser.add_subparsers(dest="command")
+
+    queue_parser = subparsers.add_parser("queue", help="sharded work queue over a (shared) directory")
+    queue_parser.add_argument("action", choices=["init", "work", "status", "merge"])
+    queue_parser.add_argument("root", help="queue directory")
+    queue_parser.add_argument("--games", default=10000, type=int, help="total number of games (init)")
+    queue_parser.add_argument("--shard-size", default=1000, type=int, help="games per shard (init)")
+    queue_parser.add_argument("--first-seed", default=0, type=int, help="seed of the first game (init)")
+    queue_parser.add_argument("--store-turns", action="store_true", help="store every turn instead of replay records (init)")
+    queue_parser.add_argument("-w", "--workers", default=1, type=int, help="worker processes to run on this machine (work)")
+    queue_parser.add_argument("--lease-seconds", default=workqueue.LEASE_SECONDS, type=float, help="lease length before a shard is reclaimed (work)")
+    queue_parser.add_argument("-o", "--output", default="merged.sqlite3", help="merged database path (merge)")
+
+    export_parser = subparsers.add_parser("export", help="save the summary plots of many games without showing them")
+    export_parser.add_argument("--ids", nargs="+", help="game ids (full or short) to export")
+    export_parser.add_argument("--range", dest="id_range", help="start:stop slice of the recorded games, e.g. 0:1000")
+    export_parser.add_argument("--sample", type=int, help="export a random sample of this many games")
+    export_parser.add_argument("--db", default=DB_PATH, help="database to read the games from")
+    export_parser.add_argument("-o", "--output", default=str(PLOT_DIR), help="directory to save the plots in")
+    export_parser.add_argument("-w", "--workers", type=int, help="worker processes (default: all cores)")
+    export_parser.add_argument("--dpi", default=150, type=int)
+
+    compare_parser = subparsers.add_parser("compare", help="compare play styles at the same tables with rotated seats")
+    compare_parser.add_argument("--rotations", default=1000, type=int, help="number of times every seat rotation is played")
+    compare_parser.add_argument("--first-seed", type=int, help="seed of the first game (default: random)")
+    compare_parser.add_argument("--policy", action="append", default=[], help="compiled style table to add to the comparison (repeatable)")
+
+    compile_parser = subparsers.add_parser("compile-style", help="compile a play style's draw decisions into a lookup table")
+    compile_parser.add_argument("style", choices=list(STYLES_BY_CODE), help="style code to compile")
+    compile_parser.add_argument("-o", "--output", required=True, help="path to save the table to")
+    compile_parser.add_argument("--code", help="style code of the compiled style (default: <style>*)")
+    compile_parser.add_argument("--benchmark", type=int, nargs="?", const=200_000, metavar="CALLS", help="time CALLS draw decisions of the original and the compiled style (default 200000)")
+
+    rare_parser = subparsers.add_parser("rare", help="estimate the probability of a rare event with importance sampling")
+    rare_parser.add_argument("event", choices=list(EVENT_TILTS))
+    rare_parser.add_argument("-g", "--games", default=2000, type=int)
+    rare_parser.add_argument("-k", "--min-count", default=1, type=int, help="count games where the event happens at least this many times")
+    rare_parser.add_argument("--uniform-fraction", default=DEFENSIVE_FRACTION, type=float, help="fraction of games played without tilt")
+    rare_parser.add_argument("--plain", action="store_true", help="plain simulation, for comparison")
+    rare_parser.add_argument("--first-seed", type=int, help="seed of the first game (default: random)")
+
+    check_parser = subparsers.add_parser("check-replays", help="check that games replayed from their seed match the stored turns")
+    check_parser.add_argument("-g", "--games", default=100, type=int)
+    check_parser.add_argument("--first-seed", type=int, help="seed of the first game (default: random)")
+
+    monitor_parser = subparsers.add_parser("monitor", help="watch the live counters of running simulations")
+    monitor_parser.add_argument("path", nargs="?", default=TELEMETRY_PATH, help="telemetry file")
+    monitor_parser.add_argument("-i", "--interval", default=1.0, type=float, help="seconds between refreshes")
+    monitor_parser.add_argument("--once", action="store_true", help="print a single refresh and exit")
+
     args = parser.parse_args()
 
-    play_flip7(num_players=args.num_players)
+    if args.command == "queue":
+        if args.action == "init":
+            workqueue.init_queue(args.root, args.games, shard_size=args.shard_size, num_players=args.num_players, first_seed=args.first_seed, store_turns=args.store_turns, num_decks=args.decks)
+        elif args.action == "work":
+            workqueue.run_workers(args.root, args.workers, lease_seconds=args.lease_seconds, telemetry_path=args.telemetry_path if args.telemetry else None)
+        elif args.action == "status":
+            print(workqueue.queue_status(args.root))
+        elif args.action == "merge":
+            num_merged = workqueue.merge_shards(args.root, args.output)
+            print(f"merged {num_merged} games into {args.output}")
+        return
+
+    if args.command == "check-replays":
+        mismatches = check_replays(args.games, num_players=args.num_players, first_seed=args.first_seed, num_decks=args.decks)
+        print(f"{args.games - len(mismatches)}/{args.games} games replayed identically")
+        if mismatches:
+            raise SystemExit(f"replays differ for {len(mismatches)} games: {', '.join(mismatches[:5])}")
+        return
+
+    if args.command == "monitor":
+        monitor(args.path, interval=args.interval, once=args.once)
+        return
+
+    if args.command == "export":
+        game_ids = select_game_ids(sql_connect_to_db(args.db), game_ids=args.ids, id_range=args.id_range, num_sample=args.sample)
+        fig_paths = export_plots(game_ids, db_path=args.db, plot_dir=Path(args.output), num_workers=args.workers, dpi=args.dpi)
+        print(f"saved {len(fig_paths)} plots to {args.output}")
+        return
+
+    if args.command == "compare":
+        styles = ALL_PLAYER_STYLES + [load_table(path) for path in args.policy]
+        comparisons = compare_styles(args.rotations, num_players=args.num_players, styles=styles, first_seed=args.first_seed, num_decks=args.decks)
+        for comparison in comparisons:
+            print(comparison.summary())
+        return
+
+    if args.command == "rare":
+        estimate = estimate_rare_event(
+            args.event,
+            args.games,
+            num_players=args.num_players,
+            min_count=args.min_count,
+            tilt=no_tilt if args.plain else None,
+            uniform_fraction=args.uniform_fraction,
+            first_seed=args.first_seed,
+            num_decks=args.decks
+        )
+        print(estimate.summary())
+        return
+
+    if args.command == "compile-style":
+        table = compile_style(STYLES_BY_CODE[args.style], style_code=args.code)
+        table.save(args.output)
+        print(f"saved {table.style_code} ({len(table.table)} states) to {args.output}")
+        if args.benchmark:
+            for style in [STYLES_BY_CODE[args.style], table]:
+                seconds = benchmark_draw_again(style, args.benchmark)
+                print(f"{args.benchmark} draw_again calls of {style.style_code}: {seconds:.3f}s ({seconds / args.benchmark * 1e9:.0f} ns/call)")
+        return
+
+    telemetry = Telemetry(args.telemetry_path) if args.telemetry else None
+
+    if args.aggregate:
+        stats = play_aggregate(args.num_games, num_players=args.num_players, reservoir_size=args.reservoir, store_turns=not args.replay_only, num_decks=args.decks, telemetry=telemetry)
+        print(stats.summary())
+    else:
+        for _i in range(args.num_games):
+            play_flip7(num_players=args.num_players, store_turns=not args.replay_only, num_decks=args.decks, telemetry=telemetry)
+
+    # An aggregate run with an empty reservoir records no game to plot
+    if args.aggregate and args.reservoir <= 0:
+        return
 
     if not args.suppress_figure:
         plot_game(save_fig=args.save_figure)
@@ -61,6 +61,7 @@ class NumberCard:
                     player.action_hand.pop(player.action_hand.index(SecondChanceActionCard()))
                 )
                 player.second_chance = False
+                player.used_second_chance = True
                 logging.debug(f" - GAME {game.game_id.split("-")[0]} - ROUND {game.round_num} - PLAYER {player.name}: action hand: {player.action_hand}")
                 return None
             else:
@@ -197,8 +198,13 @@ class Flip3ActionCard:
         Prepends the player 3 times to the draw order list
         """
         target = player.who_to_flip_three(game)
+
+        # Drawn during the forced draws of an earlier Flip 3
+        if player.flip3_draws > 0:
+            game.events["flip3_chain"] += 1
         
         for _i in range(3):
-            game.draw_order.insert(0, target)
+            game.queue_player(target, first=True)
+        target.flip3_draws += 3
         game.discard.append(self)
         logging.info(f" - GAME {game.game_id.split("-")[0]} - ROUND {game.round_num} - PLAYER {player.name}: gave the {self.title} to {target.name}")
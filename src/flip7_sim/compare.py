@@ -0,0 +1,100 @@
+from itertools import combinations
+from random import getrandbits
+import math
+
+from .game import Flip7Game, PlayerStyle, ALL_PLAYER_STYLES, play_flip7, quiet_game_logs
+from .stats import RunningStats
+
+Z_95 = 1.96
+
+class PairedDifference:
+    """Streaming paired comparison of a metric between two styles playing at the same tables"""
+
+    def __init__(self, style_a:str, style_b:str, metric:str):
+        self.style_a: str = style_a
+        self.style_b: str = style_b
+        self.metric: str = metric
+        self.diff = RunningStats() # per game
+
+    def push(self, value_a:float, value_b:float) -> None:
+        """Add one game given the metric of each style"""
+        self.diff.push(value_a - value_b)
+
+    def confidence_interval(self, z:float = Z_95) -> tuple[float, float]:
+        """Normal approximation confidence interval of the mean paired difference"""
+        half_width = z * self.diff.std / math.sqrt(max(self.diff.count, 1))
+        return self.diff.mean - half_width, self.diff.mean + half_width
+
+    def summary(self) -> str:
+        low, high = self.confidence_interval()
+        return (
+            f"{self.metric:>5} {self.style_a:>4} - {self.style_b:<4} {self.diff.mean:>+9.3f}  "
+            f"95% CI [{low:+.3f}, {high:+.3f}]  games {self.diff.count}"
+        )
+
+def rotated_seat_styles(seat_styles:list[PlayerStyle], rotation:int) -> list[PlayerStyle]:
+    """Shift every style `rotation` seats to the left"""
+    return seat_styles[rotation:] + seat_styles[:rotation]
+
+def play_rotations(first_seed:int, seat_styles:list[PlayerStyle], num_decks:int | None = None) -> list[Flip7Game]:
+    """
+    Play one game for every rotation of the styles around the table, so every style sits in every seat
+
+    Each game gets its own seed (`first_seed` onwards). Replaying one seed under every rotation does
+    not make the comparison more precise in this game: a seat's result depends far more on its style
+    and on the other players than on its cards, and the replays of a seed are correlated with each other.
+    """
+    games = []
+    for rotation in range(len(seat_styles)):
+        game = Flip7Game(len(seat_styles), seed=first_seed + rotation, seat_styles=rotated_seat_styles(seat_styles, rotation), num_decks=num_decks)
+        games.append(play_flip7(record=False, game=game))
+
+    return games
+
+def game_metrics(game:Flip7Game) -> dict[str, dict[str, float]]:
+    """Average win rate and final score of the players of each style in a game"""
+    totals: dict[str, dict[str, float]] = {}
+    counts: dict[str, int] = {}
+
+    for player in game.players:
+        style_code = player.play_style.style_code
+        if style_code not in totals:
+            totals[style_code] = {"win": 0.0, "score": 0.0}
+            counts[style_code] = 0
+        totals[style_code]["win"] += player is game.winner
+        totals[style_code]["score"] += player.game_score
+        counts[style_code] += 1
+
+    return {
+        style_code: {metric: total / counts[style_code] for metric, total in metrics.items()}
+        for style_code, metrics in totals.items()
+    }
+
+def compare_styles(num_rotations:int, num_players:int = 5, styles:list[PlayerStyle] = ALL_PLAYER_STYLES, first_seed:int | None = None, num_decks:int | None = None) -> list[PairedDifference]:
+    """
+    Compare styles playing at the same tables
+
+    Every rotation of the seat assignment is played `num_rotations` times, so every style plays from
+    every seat equally often and the order of play doesn't favour any style. The win rate and final
+    score of each pair of styles are compared game by game as paired differences.
+    """
+    if first_seed is None:
+        first_seed = getrandbits(62)
+
+    seat_styles = [styles[i % len(styles)] for i in range(1, num_players+1)]
+    style_codes = list(dict.fromkeys(style.style_code for style in seat_styles))
+
+    comparisons = [
+        PairedDifference(style_a, style_b, metric)
+        for metric in ["win", "score"]
+        for style_a, style_b in combinations(style_codes, 2)
+    ]
+
+    with quiet_game_logs():
+        for i in range(num_rotations):
+            for game in play_rotations(first_seed + i * num_players, seat_styles, num_decks):
+                metrics = game_metrics(game)
+                for comparison in comparisons:
+                    comparison.push(metrics[comparison.style_a][comparison.metric], metrics[comparison.style_b][comparison.metric])
+
+    return comparisons
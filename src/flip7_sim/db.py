@@ -1,4 +1,5 @@
 from datetime import datetime
+import json
 import sqlite3
 
 # from flip7_sim import Flip7Game, Player
@@ -57,12 +58,27 @@ def sql_create_tables(con: sqlite3.Connection) -> None:
     cursor.execute("CREATE TABLE IF NOT EXISTS games (game_id, timestamp)")
     cursor.execute("CREATE TABLE IF NOT EXISTS players (player_id, game_id, profile)")
     cursor.execute("CREATE TABLE IF NOT EXISTS player_turns (player_id, turn_id, round_id, game_id, game_score, round_score, num_cards, hand, stay, busted, frozen, second_chance)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS replays (game_id, seed, styles, num_decks)")
+    if "num_decks" not in [column[1] for column in cursor.execute("PRAGMA table_info(replays)")]:
+        cursor.execute("ALTER TABLE replays ADD COLUMN num_decks DEFAULT 1")
+    if "engine_version" not in [column[1] for column in cursor.execute("PRAGMA table_info(replays)")]:
+        # Records written before engine versions were stored are left NULL and can't be replayed
+        cursor.execute("ALTER TABLE replays ADD COLUMN engine_version")
+    cursor.execute("CREATE TABLE IF NOT EXISTS checkpoints (shard_id, seed, game_id)")
+    # Every seed of a work queue run is played once; catches two workers playing the same shard
+    if cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'checkpoints_seed'").fetchone() is None:
+        # Checkpoints written before the index existed may repeat a seed. Keep the first; the games of the
+        # others are then unfinished and dropped when the shard is worked again
+        cursor.execute("DELETE FROM checkpoints WHERE rowid NOT IN (SELECT MIN(rowid) FROM checkpoints GROUP BY seed)")
+        cursor.execute("CREATE UNIQUE INDEX checkpoints_seed ON checkpoints (seed)")
+        con.commit()
+    cursor.execute("CREATE TABLE IF NOT EXISTS aggregate_stats (run_id, timestamp, style_code, seat, games, wins, score_mean, score_var, rounds_mean, rounds_var, busts, flip7s, score_hist, rounds_hist)")
 
 
 def sql_connect_to_db(db_path:str = DB_PATH) -> sqlite3.Connection: 
     """Initialize and connect to the sqlite database"""
 
-    con = sqlite3.connect(DB_PATH)
+    con = sqlite3.connect(db_path)
     sql_register_sqlite_converters()
     sql_create_tables(con)
 
@@ -84,6 +100,29 @@ def sql_write_players(game, con: sqlite3.Connection) -> None:
         cursor.execute("INSERT INTO players VALUES (?, ?, ?)", (player.name, game.game_id, player.play_style.style_code))
     con.commit()
 
+def sql_write_replay(game, con: sqlite3.Connection) -> None:
+    """
+    Write the compact replay record for a game: its seed, the style code of each seat, the number of decks
+    and the engine version that played it
+
+    This is enough to rebuild every turn of the game with `replay.replay_game` on the same engine version
+    """
+    cursor = con.cursor()
+
+    styles = ",".join(player.play_style.style_code for player in game.players)
+    cursor.execute(
+        "INSERT INTO replays (game_id, seed, styles, num_decks, engine_version) VALUES (?, ?, ?, ?, ?)",
+        (game.game_id, game.seed, styles, game.num_decks, game.engine_version)
+    )
+    con.commit()
+
+def sql_write_checkpoint(shard_id:str, game, con: sqlite3.Connection) -> None:
+    """Mark a game of a work queue shard as complete"""
+    cursor = con.cursor()
+
+    cursor.execute("INSERT INTO checkpoints VALUES (?, ?, ?)", (shard_id, game.seed, game.game_id))
+    con.commit()
+
 def sql_write_player_turn(player, game, con: sqlite3.Connection) -> None:
     cursor = con.cursor()
 
@@ -108,3 +147,38 @@ def sql_write_player_turn(player, game, con: sqlite3.Connection) -> None:
     )
     con.commit()
 
+def sql_delete_game(game_id:str, con: sqlite3.Connection) -> None:
+    """Remove every row recorded for a game"""
+    cursor = con.cursor()
+
+    for table in ["games", "players", "player_turns", "replays"]:
+        cursor.execute(f"DELETE FROM {table} WHERE game_id = ?", (game_id,))
+    con.commit()
+
+def sql_write_aggregate_stats(run_id:str, stats, con: sqlite3.Connection) -> None:
+    """Write the streaming aggregates of a run, one row per (style, seat)"""
+    cursor = con.cursor()
+    timestamp = datetime.now()
+
+    for (style_code, seat), seat_stats in sorted(stats.by_style_seat.items()):
+        data = {
+            "run_id": run_id,
+            "timestamp": timestamp,
+            "style_code": style_code,
+            "seat": seat,
+            "games": seat_stats.score.count,
+            "wins": seat_stats.wins,
+            "score_mean": seat_stats.score.mean,
+            "score_var": seat_stats.score.variance,
+            "rounds_mean": seat_stats.rounds.mean,
+            "rounds_var": seat_stats.rounds.variance,
+            "busts": seat_stats.busts,
+            "flip7s": seat_stats.flip7s,
+            "score_hist": json.dumps(seat_stats.score_hist.counts),
+            "rounds_hist": json.dumps(seat_stats.rounds_hist.counts),
+        }
+        cursor.execute(
+            "INSERT INTO aggregate_stats VALUES (:run_id, :timestamp, :style_code, :seat, :games, :wins, :score_mean, :score_var, :rounds_mean, :rounds_var, :busts, :flip7s, :score_hist, :rounds_hist)",
+            data
+        )
+    con.commit()
@@ -1,10 +1,21 @@
 from typing import Any, Protocol
-from random import sample, choice
+from collections import Counter, deque
+from contextlib import contextmanager
+from heapq import nlargest
+from math import ceil
+from random import Random, getrandbits
+from time import perf_counter_ns
 from uuid import uuid4
 import logging
+import sqlite3
 
 from .cards import Card, NumberCard, MultModifierCard, AddModifierCard, FreezeActionCard, SecondChanceActionCard, Flip3ActionCard
-from .db import sql_connect_to_db, sql_write_game, sql_write_players, sql_write_player_turn
+from .db import sql_connect_to_db, sql_write_game, sql_write_players, sql_write_player_turn, sql_write_replay
+
+# Version of the game engine stored with every replay record. Bump it whenever a change to the game
+# logic, the play styles or the use of the random generators makes a seed play out differently, so that
+# older replay records are refused instead of silently rebuilt wrong (see replay.py)
+ENGINE_VERSION = 1
 
 ######################################################################################################
 # Player and Game
@@ -23,10 +34,18 @@ class Player:
         self.stay: bool = False
         self.frozen: bool = False
         self.second_chance: bool = False
+        self.num_busts: int = 0
+        self.num_flip7s: int = 0
+        self.used_second_chance: bool = False
+        self.queued: int = 0 # times the player is in game.draw_order
+        self.flip3_draws: int = 0 # forced draws still owed to Flip 3 cards this round
+
+        # Styles decide for this player directly instead of looking it up by name
+        self.play_style.player = self
 
     def is_active(self):
         """Determine if a player is active based on other statuses"""
-        return not any([self.busted, self.stay, self.frozen])
+        return not (self.busted or self.stay or self.frozen)
 
     def update_round_score(self) -> None:
         """Update the player's score for the round based on number and modifier cards"""
@@ -61,10 +80,13 @@ class Player:
         self.busted = False
         self.stay = False
         self.second_chance = False
+        self.used_second_chance = False
         self.frozen = False
 
         self.turn = 0
         self.round_score = 0
+        self.queued = 0
+        self.flip3_draws = 0
     
     def dump_hand(self) -> dict:
         """Return a dictionary representation of a players cards"""
@@ -95,15 +117,79 @@ class Player:
 
 
 class Flip7Game:
-    def __init__(self, num_players:int):
-        self.game_id: str = str(uuid4())
-        self.players: list[Player] = make_players(num_players)
-        self.draw_order: list[Player] = []
-        self.deck: list[Card] = build_deck()
+    engine_version: int = ENGINE_VERSION
+
+    def __init__(self, num_players:int, seed:int | None = None, game_id:str | None = None, seat_styles:list | None = None, num_decks:int | None = None):
+        self.game_id: str = game_id or str(uuid4())
+
+        # Every random event in a game is drawn from one of these two generators, so the seed and the
+        # seat styles fully determine the game (see replay.py). Shuffles have their own generator so
+        # that games can draw cards their own way without touching the style decisions (see rare.py)
+        self.seed: int = getrandbits(63) if seed is None else seed
+        self.deck_rng: Random = Random(self.seed)
+        self.rng: Random = Random(f"decisions-{self.seed}")
+
+        if seat_styles is None:
+            self.players: list[Player] = make_players(num_players)
+        else:
+            self.players: list[Player] = make_seated_players(seat_styles)
+        self.draw_order: deque[Player] = deque()
+
+        # Large tables play from a shoe of several decks
+        self.num_decks: int = num_decks or decks_for_players(len(self.players))
+        self.deck: list[Card] = build_deck(self.deck_rng, self.num_decks)
         self.discard: list[Card] = []
         self.win_score: int = 200
         self.flip7_bonus: int = 35
         self.round_num = 0
+        self.winner: Player | None = None
+        self.leaders: list[Player] = [] # top two game scores, updated at the start of every round
+
+        # Counts of notable events, e.g. "flip7_x2" (see rare.py)
+        self.events: Counter = Counter()
+
+    def start_round(self) -> None:
+        """Build the per-round views of the players"""
+        self.round_num += 1
+
+        self.draw_order = deque()
+        for player in self.players:
+            if player.is_active():
+                self.queue_player(player)
+
+        self.leaders = nlargest(2, self.players, key=lambda p: p.game_score)
+
+    def opponent_leader(self, player:Player) -> Player:
+        """The opponent of `player` with the highest game score at the start of the round"""
+        if self.leaders[0] is not player or len(self.leaders) == 1:
+            return self.leaders[0]
+        return self.leaders[1]
+
+    def queued_players(self) -> list[Player]:
+        """Active players waiting in the draw order, each listed once"""
+        return list(dict.fromkeys(player for player in self.draw_order if player.is_active()))
+
+    def queue_player(self, player:Player, first:bool = False) -> None:
+        """Add a player to the end (or the front) of the draw order"""
+        if first:
+            self.draw_order.appendleft(player)
+        else:
+            self.draw_order.append(player)
+        player.queued += 1
+
+    def next_player(self) -> Player | None:
+        """
+        Pop the next active player from the draw order. Returns None once the draw order is empty
+
+        Players that became inactive while waiting in the draw order are dropped here.
+        """
+        while self.draw_order:
+            player = self.draw_order.popleft()
+            player.queued -= 1
+            if player.is_active():
+                return player
+            logging.debug(f" - GAME {self.game_id.split("-")[0]} - ROUND {self.round_num} - PLAYER {player.name}: removed from draw order")
+        return None
 
     
     def draw_card(self):
@@ -116,7 +202,9 @@ class Flip7Game:
             drawn_card = self.deck.pop()
         except IndexError:
             logging.info(f" - GAME {self.game_id.split("-")[0]} - ROUND {self.round_num}: Deck empty, reshuffling Discard pile (n={len(self.discard)})")
-            self.deck = sample(self.discard, k=len(self.discard))
+            if not self.discard:
+                raise RuntimeError(f"every card of the {self.num_decks} deck shoe is in a player's hand; play with more decks")
+            self.deck = self.deck_rng.sample(self.discard, k=len(self.discard))
             self.discard = []
             drawn_card = self.deck.pop()
         
@@ -134,6 +222,7 @@ class PlayerStyle(Protocol):
     """
 
     player_name: str
+    player: Player # set by Player.__init__
     style_code: str = ""
 
     def __call__(self, player_name):
@@ -169,30 +258,28 @@ class ShayneToppStyle:
     
     def who_to_flip_three(self, game:Flip7Game) -> Player:
         """Always take the flip three"""
-        return [player for player in game.players if player.name == self.player_name][0]
+        return self.player
 
     def who_to_freeze(self, game:Flip7Game) -> Player:
         """Freeze the top threat to the player getting to draw again"""
 
-        active_players = [player for player in game.players if player.is_active()]
-
-        other_players = [player for player in active_players if player.name != self.player_name]
+        other_players = [player for player in game.players if player.is_active() and player is not self.player]
 
         if other_players:
-            return sorted(other_players, key=lambda x: x.round_score)[-1]
+            return top_round_score(other_players)
         else:
-            return [player for player in active_players if player.name == self.player_name][0]
+            return self.player
     
     def who_to_give_2chance(self, game:Flip7Game) -> Player | None:
         """Give the second chance to yourself, then a random other player, then discard"""
 
-        me = [player for player in game.players if player.name == self.player_name][0]
-        players_wo_2chance = list(set([player for player in game.draw_order if not player.second_chance]))
-
-        if me in players_wo_2chance:
+        me = self.player
+        if me.queued and me.is_active() and not me.second_chance:
             return me
+
+        players_wo_2chance = [player for player in game.queued_players() if not player.second_chance]
         if players_wo_2chance:
-            return choice(players_wo_2chance)
+            return game.rng.choice(players_wo_2chance)
         else:
             return None
     
@@ -206,101 +293,146 @@ class ThreeAndOutStyle():
 
     def draw_again(self, game:Flip7Game) -> bool:
         """Do not draw after 3 number cards"""
-        me = [player for player in game.players if player.name == self.player_name][0]
-
-        return len(me.hand) < 3
+        return len(self.player.hand) < 3
     
     def who_to_flip_three(self, game:Flip7Game) -> Player:
         """Take the flip three if you have no cards. Otherwise, choose another player at random"""
 
-        me = [player for player in game.players if player.name == self.player_name][0]
-
-        other_players = list(set([player for player in game.draw_order if player.name != self.player_name]))
+        me = self.player
 
         if len(me.hand) == 0:
             return me
-        elif other_players:
-            return choice(other_players)
+
+        other_players = [player for player in game.queued_players() if player is not me]
+        if other_players:
+            return game.rng.choice(other_players)
         else:
             return me
         
     def who_to_freeze(self, game:Flip7Game) -> Player:
         """Freeze the top threat to the player getting to draw again"""
         
-        freeze_target = [player for player in game.players if player.name == self.player_name][0]
-
-        other_players = list(set([player for player in game.draw_order if player.name != self.player_name]))
+        other_players = [player for player in game.queued_players() if player is not self.player]
 
         if other_players:
-            freeze_target = sorted(other_players, key=lambda x: x.round_score)[-1]
+            return top_round_score(other_players)
         
-        return freeze_target
+        return self.player
     
     def who_to_give_2chance(self, game:Flip7Game) -> Player | None:
         """Give the second chance to yourself, then a random other player, then discard"""
 
-        me = [player for player in game.players if player.name == self.player_name][0]
-        players_wo_2chance = list(set([player for player in game.draw_order if not player.second_chance]))
-
-        if me in players_wo_2chance:
+        me = self.player
+        if me.queued and me.is_active() and not me.second_chance:
             return me
+
+        players_wo_2chance = [player for player in game.queued_players() if not player.second_chance]
         if players_wo_2chance:
-            return choice(players_wo_2chance)
+            return game.rng.choice(players_wo_2chance)
         else:
             return None
 
+def top_round_score(players:list[Player]) -> Player:
+    """The player with the highest round score; the last one listed wins ties"""
+    return max(reversed(players), key=lambda x: x.round_score)
+
 
 
 ALL_PLAYER_STYLES = [ShayneToppStyle, ThreeAndOutStyle]
+STYLES_BY_CODE = {style.style_code: style for style in ALL_PLAYER_STYLES}
 
 ######################################################################################################
 # Game building funcs
 
-def build_deck() -> list[Card]:
-    """Build the flip7 deck"""
+PLAYERS_PER_DECK = 18
+
+def decks_for_players(num_players:int) -> int:
+    """Number of decks in the shoe so that large tables do not run out of cards"""
+    return max(1, ceil(num_players / PLAYERS_PER_DECK))
+
+def build_deck(rng:Random | None = None, num_decks:int = 1) -> list[Card]:
+    """Build a shoe of `num_decks` flip7 decks, shuffled with `rng`"""
 
     deck = []
 
-    # Add number cards
-    deck.append(NumberCard("0", 0))
+    for _deck in range(num_decks):
+        # Add number cards
+        deck.append(NumberCard("0", 0))
 
-    for i in range(1, 13):
-        for j in range(i):
-            deck.append(NumberCard(str(i), int(i)))
+        for i in range(1, 13):
+            for j in range(i):
+                deck.append(NumberCard(str(i), int(i)))
 
-    # Add modifier cards
-    deck.append(MultModifierCard("x2", 2))
+        # Add modifier cards
+        deck.append(MultModifierCard("x2", 2))
 
-    add_modifier_values = [2, 4, 6, 8, 10]
-    for val in add_modifier_values:
-        deck.append(AddModifierCard(f"+{val}", val))
+        add_modifier_values = [2, 4, 6, 8, 10]
+        for val in add_modifier_values:
+            deck.append(AddModifierCard(f"+{val}", val))
 
-    # Add action cards
-    for i in range(3):
-        deck.append(FreezeActionCard())
-        deck.append(SecondChanceActionCard())
-        deck.append(Flip3ActionCard())
+        # Add action cards
+        for i in range(3):
+            deck.append(FreezeActionCard())
+            deck.append(SecondChanceActionCard())
+            deck.append(Flip3ActionCard())
     
-    shuffled_deck = sample(deck, k=len(deck))
+    if rng is None:
+        rng = Random()
+    shuffled_deck = rng.sample(deck, k=len(deck))
 
     return shuffled_deck
 
 def make_players(num_players: int, styles:list[PlayerStyle] = ALL_PLAYER_STYLES) -> list[Player]:
     """Create a list of players for the game."""
 
+    seat_styles = [styles[i % len(styles)] for i in range(1, num_players+1)]
+
+    return make_seated_players(seat_styles)
+
+def make_seated_players(seat_styles:list[PlayerStyle]) -> list[Player]:
+    """Create one player per seat, seat i playing with seat_styles[i-1]"""
+
     player_list = []
-    for i in range(1, num_players+1):
+    for i, style in enumerate(seat_styles, start=1):
         name = f"Player {i}"
-        style = styles[i % len(styles)]
         player = Player(name, style(name))
         player_list.append(player)
     
     return player_list
 
-def play_flip7(num_players:int = 5):
+@contextmanager
+def quiet_game_logs():
+    """Skip the INFO log lines of the games played inside the block"""
+    previous_disable = logging.root.manager.disable
+    logging.disable(logging.INFO)
+    try:
+        yield
+    finally:
+        logging.disable(previous_disable)
+
+def no_clock() -> int:
+    """Stands in for perf_counter_ns when telemetry is off"""
+    return 0
+
+def play_flip7(
+    num_players:int = 5,
+    con:sqlite3.Connection | None = None,
+    record:bool = True,
+    store_turns:bool = True,
+    game:Flip7Game | None = None,
+    num_decks:int | None = None,
+    telemetry:Any = None
+) -> Flip7Game:
     """
     Simulate a game of Flip 7
 
+    When `record` is False nothing is written to the database; the finished game is returned so that
+    callers (e.g. `stats.play_aggregate`) can summarize it themselves. When `store_turns` is False only
+    the game, its players and its replay record are written; turns can be rebuilt later with
+    `replay.replay_game`. Pass a prepared `game` to play it instead of a fresh one. `num_decks` defaults
+    to enough decks for the table (see `decks_for_players`). Pass a `telemetry.Telemetry` to publish
+    counters and phase timings for `flip7 monitor`.
+
     Terms:
 
     Game: composed of multiple Rounds 
@@ -312,45 +444,58 @@ def play_flip7(num_players:int = 5):
         is a number card that is already in the player's hand, that player busted
     """
 
-    CON = sql_connect_to_db()
+    CON = con
+    if record and CON is None:
+        CON = sql_connect_to_db()
 
-    GAME = Flip7Game(num_players=num_players)
-    sql_write_game(GAME, CON)
-    sql_write_players(GAME, CON)
+    GAME = game if game is not None else Flip7Game(num_players=num_players, num_decks=num_decks)
+    if record:
+        sql_write_game(GAME, CON)
+        # Seat styles are part of the replay record; the players table is only needed next to stored turns
+        if store_turns:
+            sql_write_players(GAME, CON)
+        sql_write_replay(GAME, CON)
 
     logging.info(f" - GAME {GAME.game_id.split("-")[0]}: BEGIN GAME ")
 
+    # Phase timings only cost a clock read when telemetry is on
+    clock = perf_counter_ns if telemetry is not None else no_clock
+    game_start = clock()
+
     # Start Game 
     while all([player.game_score < GAME.win_score for player in GAME.players]):
 
         # Start Round
-        GAME.round_num += 1
+        GAME.start_round()
         logging.info(f" - GAME {GAME.game_id.split("-")[0]} - ROUND {GAME.round_num}: STARTING ROUND")
-    
-        # GAME.active_players = [player for player in GAME.players if player.is_active()]
-        # logging.info(f" - GAME {GAME.game_id.split("-")[0]} - ROUND {GAME.round_num}: active players: {[p.name for p in GAME.active_players]}")
-
-        GAME.draw_order = [player for player in GAME.players if player.is_active()]
         logging.info(f" - GAME {GAME.game_id.split("-")[0]} - ROUND {GAME.round_num}: draw order: {[p.name for p in GAME.draw_order]}")
 
 
-        while GAME.draw_order:
-            
-            player = GAME.draw_order.pop(0)
+        while (player := GAME.next_player()) is not None:
 
             # Start Turn
             player.turn += 1
             logging.info(f" - GAME {GAME.game_id.split("-")[0]} - ROUND {GAME.round_num} - PLAYER {player.name}: turn {player.turn} start")
 
+            turn_start = clock()
             if player.draw_again(GAME):
+                decided = clock()
                 
                 drawn_card = GAME.draw_card()
                 logging.info(f" - GAME {GAME.game_id.split("-")[0]} - ROUND {GAME.round_num} - PLAYER {player.name}: drew a {drawn_card.title}")
+                drawn = clock()
 
-                # Resolve card based on type
+                # Resolve card based on type. The card counts as one of the player's pending Flip 3 draws
+                # while it resolves, so a Flip 3 drawn by a player who owes draws is seen as a chain
+                forced_draw = player.flip3_draws > 0
                 drawn_card.resolve(player = player, game = GAME)
+                if forced_draw:
+                    player.flip3_draws -= 1
+                resolved = clock()
             else:
+                decided = drawn = resolved = clock()
                 player.stay = True
+                player.flip3_draws = 0
                 logging.info(f" - GAME {GAME.game_id.split("-")[0]} - ROUND {GAME.round_num} - PLAYER {player.name}: decided to stay")
 
 
@@ -361,7 +506,11 @@ def play_flip7(num_players:int = 5):
             logging.info(f" - GAME {GAME.game_id.split("-")[0]} - ROUND {GAME.round_num} - PLAYER {player.name}: round score is now {player.round_score}")
             
             # Write player score to db
-            sql_write_player_turn(player, GAME, CON)
+            if record and store_turns:
+                sql_write_player_turn(player, GAME, CON)
+
+            if telemetry is not None:
+                telemetry.turn(decided - turn_start, drawn - decided, resolved - drawn, clock() - resolved)
 
             # Stop round if player gets 7 cards
             if len(player.hand) == 7:
@@ -373,23 +522,29 @@ def play_flip7(num_players:int = 5):
 
             logging.info(f" - GAME {GAME.game_id.split("-")[0]} - ROUND {GAME.round_num} - PLAYER {player.name}: turn complete")
             
-            # Manage the round draw order based on player status
-            if player.is_active() and not player in GAME.draw_order:
-                GAME.draw_order.append(player)
+            # Manage the round draw order based on player status. Inactive players are dropped by next_player()
+            if player.is_active() and not player.queued:
+                GAME.queue_player(player)
                 logging.info(f" - GAME {GAME.game_id.split("-")[0]} - ROUND {GAME.round_num} - PLAYER {player.name}: added back to the draw order")
-            
-            for p in GAME.draw_order:
-                if not p.is_active():
-                    GAME.draw_order.remove(p)
-                    logging.info(f" - GAME {GAME.game_id.split("-")[0]} - ROUND {GAME.round_num} - PLAYER {player.name}: {p.name} removed from draw order")
 
-            logging.info(f" - GAME {GAME.game_id.split("-")[0]} - ROUND {GAME.round_num} - PLAYER {player.name}: Draw Order: {[p.name for p in GAME.draw_order]}")
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug(f" - GAME {GAME.game_id.split("-")[0]} - ROUND {GAME.round_num} - PLAYER {player.name}: Draw Order: {[p.name for p in GAME.draw_order]}")
 
         logging.info(f" - GAME {GAME.game_id.split("-")[0]} - ROUND {GAME.round_num}: Round Complete")
 
         # Update player status for next round
         for player in GAME.players:
 
+            if player.busted:
+                player.num_busts += 1
+            if len(player.hand) == 7:
+                player.num_flip7s += 1
+                GAME.events["flip7"] += 1
+                if any(isinstance(card, MultModifierCard) for card in player.modifier_hand):
+                    GAME.events["flip7_x2"] += 1
+                if player.used_second_chance:
+                    GAME.events["flip7_2chance"] += 1
+
             player.update_game_score()
             logging.info(f" - GAME {GAME.game_id.split("-")[0]} - ROUND {GAME.round_num} - PLAYER {player.name}: Score Summary: round {player.round_score:03d}   game {player.game_score:03d}   hand {[c.value for c in player.hand] or '[busted]'}")
             player.round_reset(GAME)
@@ -397,8 +552,14 @@ def play_flip7(num_players:int = 5):
     logging.info(f" - GAME {GAME.game_id.split("-")[0]}: GAME OVER")
 
     winner = sorted(GAME.players, key=lambda p: p.game_score)[-1]
+    GAME.winner = winner
     logging.info(f" - GAME {GAME.game_id.split("-")[0]}: {winner.name} won with {winner.game_score} points!")
 
     logging.info(f" - GAME {GAME.game_id.split("-")[0]}: Game Summary:")
     for player in GAME.players:
-        logging.info(f" - GAME {GAME.game_id.split("-")[0]}: {player.name}: {player.game_score}")
\ No newline at end of file
+        logging.info(f" - GAME {GAME.game_id.split("-")[0]}: {player.name}: {player.game_score}")
+
+    if telemetry is not None:
+        telemetry.end_game(GAME, clock() - game_start)
+
+    return GAME
@@ -1,3 +1,6 @@
+from concurrent.futures import ProcessPoolExecutor
+from random import sample
+import os
 import sqlite3
 import sys
 from pathlib import Path
@@ -6,7 +9,8 @@ import matplotlib.pyplot as plt
 import pandas as pd
 from pandas import DataFrame
 
-from flip7_sim.db import sql_connect_to_db
+from flip7_sim.db import sql_connect_to_db, DB_PATH
+from flip7_sim.replay import get_replay, replay_game
 
 PLOT_DIR = Path("plots")
 
@@ -20,7 +24,12 @@ def get_turn_table(game_id:str, con:sqlite3.Connection) -> DataFrame:
     (round_id, turn_id) |    15    |     0    | ... |     8    |
 
     """
-    df = pd.read_sql_query(f"SELECT * FROM player_turns WHERE game_id = '{game_id}'", con)
+    query = f"SELECT * FROM player_turns WHERE game_id = '{game_id}'"
+    df = pd.read_sql_query(query, con)
+
+    # Games stored as replay records only are expanded on demand
+    if df.empty:
+        df = pd.read_sql_query(query, replay_game(game_id, con))
 
     score_df = df.set_index(['round_id', 'turn_id', 'player_id'])[['game_score', 'round_score']]
     score_df["running_score"] = score_df["game_score"] + score_df["round_score"]
@@ -43,9 +52,10 @@ def get_round_locs_labels(df):
 
     locs = []
     labels = []
-    for i in round_ids.unique():
-        locs.append(list(round_ids).index(i))
-        labels.append(f"R{i}")
+    for loc, i in enumerate(round_ids):
+        if not labels or labels[-1] != f"R{i}":
+            locs.append(loc)
+            labels.append(f"R{i}")
 
     return locs, labels
 
@@ -53,17 +63,28 @@ def get_player_styles(game_id:str, con:sqlite3.Connection) -> dict[str,str]:
     """Get the play style for each player in the game"""
 
     cursor = con.execute("SELECT player_id, profile FROM players WHERE game_id = :game_id", {"game_id":game_id})
-    
-    return dict(cursor.fetchall())
+    styles = dict(cursor.fetchall())
 
-def make_summary_plot(game_id:str, con:sqlite3.Connection) -> None:
-    """Make the summary plot for the game"""
+    # Games stored as replay records only keep the seat styles in their replay record
+    if not styles:
+        _seed, style_codes, _num_decks, _engine_version = get_replay(game_id, con)
+        styles = {f"Player {i}": code for i, code in enumerate(style_codes, start=1)}
 
-    df = get_turn_table(game_id, con)
+    return styles
 
-    fig, ax = plt.subplots(1, 1, figsize=(8,4))
+def setup_summary_axes(ax) -> None:
+    """Draw the parts of the summary plot that are the same for every game"""
 
-    df.plot(ax=ax, lw=1)
+    ax.set_ylabel("Score")
+    ax.axhline(200, ls="--", lw=0.5, c='r')
+    ax.grid(axis="x")
+
+def draw_summary(ax, game_id:str, con:sqlite3.Connection) -> None:
+    """Draw the game specific parts of the summary plot on axes prepared by `setup_summary_axes`"""
+
+    df = get_turn_table(game_id, con)
+
+    df.plot(ax=ax, lw=1, legend=False)
 
     # Title
     short_id = game_id.split("-")[0]
@@ -75,17 +96,18 @@ def make_summary_plot(game_id:str, con:sqlite3.Connection) -> None:
     ax.set_xticks(locs)
     ax.set_xticklabels(labels)
 
-    # Y axis
-    ax.set_ylabel("Score")
-    ax.axhline(200, ls="--", lw=0.5, c='r')
-
     # legend
-    ax.legend(title="")
     player_styles = get_player_styles(game_id, con)
-    ax.legend(labels= [f"{name} - {player_styles[name]}" for name in player_styles] )
+    player_lines = ax.get_lines()[-len(df.columns):]
+    ax.legend(handles=player_lines, labels=[f"{name} - {player_styles[name]}" for name in df.columns])
 
-    # Other
-    ax.grid(axis="x")
+def make_summary_plot(game_id:str, con:sqlite3.Connection) -> None:
+    """Make the summary plot for the game"""
+
+    fig, ax = plt.subplots(1, 1, figsize=(8,4))
+
+    setup_summary_axes(ax)
+    draw_summary(ax, game_id, con)
 
 def plot_game(save_fig:bool=False):
     """
@@ -107,5 +129,82 @@ def plot_game(save_fig:bool=False):
 
     plt.show()
 
+######################################################################################################
+# Batch export
+
+def select_game_ids(con:sqlite3.Connection, game_ids:list[str] | None = None, id_range:str | None = None, num_sample:int | None = None) -> list[str]:
+    """
+    Pick the games to export
+
+    game_ids: full game ids or their short (first block) form
+    id_range: "start:stop" slice over the games in the order they were recorded
+    num_sample: number of games sampled at random from the selection
+    """
+    all_game_ids = [game_id for (game_id,) in con.execute("SELECT game_id FROM games ORDER BY rowid")]
+
+    selected = all_game_ids
+    if game_ids:
+        wanted = set(game_ids)
+        selected = [game_id for game_id in selected if game_id in wanted or game_id.split("-")[0] in wanted]
+    if id_range:
+        start, stop = [int(i) if i else None for i in id_range.split(":")]
+        selected = selected[start:stop]
+    if num_sample is not None:
+        selected = sample(selected, k=min(num_sample, len(selected)))
+
+    return selected
+
+# Per worker process state, set by _init_export_worker
+_EXPORT = {}
+
+def _init_export_worker(db_path:str, plot_dir:Path, dpi:int) -> None:
+    """Open the db and build the figure template that every render in this process reuses"""
+    plt.switch_backend("Agg")
+
+    fig, ax = plt.subplots(1, 1, figsize=(8,4))
+    setup_summary_axes(ax)
+
+    _EXPORT.update(
+        con = sql_connect_to_db(db_path),
+        fig = fig,
+        ax = ax,
+        template_lines = list(ax.lines),
+        plot_dir = plot_dir,
+        dpi = dpi,
+    )
+
+def _export_game(game_id:str) -> Path:
+    """Render one game onto the worker's template figure and save it"""
+    ax = _EXPORT["ax"]
+
+    # Remove the previous game's artists, keeping the template
+    for line in ax.lines:
+        if line not in _EXPORT["template_lines"]:
+            line.remove()
+    ax.set_prop_cycle(None)
+    ax.relim()
+
+    draw_summary(ax, game_id, _EXPORT["con"])
+
+    short_id = game_id.split("-")[0]
+    fig_path = _EXPORT["plot_dir"] / f"game_{short_id}.png"
+    _EXPORT["fig"].savefig(fig_path, dpi=_EXPORT["dpi"])
+
+    return fig_path
+
+def export_plots(game_ids:list[str], db_path:str = DB_PATH, plot_dir:Path = PLOT_DIR, num_workers:int | None = None, dpi:int = 150) -> list[Path]:
+    """
+    Save the summary plot of every game in `game_ids` using the non-interactive Agg backend
+
+    Rendering is spread across `num_workers` processes (all cores by default). Each process builds its
+    figure once and redraws only the game specific artists for every plot.
+    """
+    plot_dir.mkdir(parents=True, exist_ok=True)
+    num_workers = num_workers or os.cpu_count()
+    chunksize = max(1, len(game_ids) // (4 * num_workers))
+
+    with ProcessPoolExecutor(num_workers, initializer=_init_export_worker, initargs=(db_path, plot_dir, dpi)) as executor:
+        return list(executor.map(_export_game, game_ids, chunksize=chunksize))
+
 if __name__ == "__main__":
     plot_game()
\ No newline at end of file
@@ -0,0 +1,188 @@
+from pathlib import Path
+from time import perf_counter
+import base64
+import json
+import math
+
+from .cards import NumberCard
+from .game import Flip7Game, Player, PlayerStyle, STYLES_BY_CODE
+
+# State key dimensions: (name, bucket width, number of buckets). The last bucket of each dimension
+# also holds every value past it
+STATE_DIMS = [
+    ("hand_size", 1, 8),
+    ("round_score", 10, 12),
+    ("game_score", 20, 11),
+    ("leader_score", 20, 11),
+]
+
+######################################################################################################
+# Decision tables
+
+class DecisionTable:
+    """
+    A style's draw_again rule compiled into a lookup table indexed by a compact state key
+
+    The key is (hand size, round score bucket, game score bucket, bucket of the best opponent's game score).
+    A table is used like a style class: `table(player_name)` returns a TableStyle that draws with a
+    single lookup and leaves the other decisions to the style it was compiled from.
+    """
+
+    def __init__(self, style_code:str, base_style_code:str, table:bytearray, dims:list = STATE_DIMS):
+        self.style_code: str = style_code
+        self.base_style_code: str = base_style_code
+        self.table: bytearray = table
+        self.dims: list = [tuple(dim) for dim in dims]
+
+        num_states = math.prod(num_buckets for _name, _width, num_buckets in self.dims)
+        if len(self.dims) != len(STATE_DIMS) or len(table) != num_states:
+            raise ValueError(f"decision table for {style_code} has {len(table)} entries, its dims {self.dims} need {num_states}")
+
+        # Row major strides, so that the index is a sum of bucket * stride
+        self.strides: list[int] = []
+        stride = 1
+        for _name, _width, num_buckets in self.dims[::-1]:
+            self.strides.insert(0, stride)
+            stride *= num_buckets
+
+    def __call__(self, player_name:str) -> "TableStyle":
+        return TableStyle(player_name, self)
+
+    def index(self, values:list[int]) -> int:
+        """Flat table index of a state given the raw value of each dimension"""
+        index = 0
+        for value, stride, (_name, width, num_buckets) in zip(values, self.strides, self.dims):
+            index += min(max(value, 0) // width, num_buckets - 1) * stride
+        return index
+
+    def round_row(self, player:Player, game:Flip7Game) -> bytearray:
+        """
+        Entries of every (hand size, round score) bucket for the player's game score and leader buckets,
+        which only change between rounds. Entry hand_bucket * num_round_buckets + round_bucket of the row
+        """
+        offset = self.index([0, 0, player.game_score, game.opponent_leader(player).game_score])
+
+        # Hand size and round score are the leading dims, so their entries are one stride apart
+        return self.table[offset::self.strides[1]]
+
+    def save(self, path:str | Path) -> None:
+        data = {
+            "style_code": self.style_code,
+            "base_style_code": self.base_style_code,
+            "dims": self.dims,
+            "table": base64.b64encode(self.table).decode(),
+        }
+        Path(path).write_text(json.dumps(data))
+
+    @classmethod
+    def load(cls, path:str | Path) -> "DecisionTable":
+        data = json.loads(Path(path).read_text())
+        return cls(data["style_code"], data["base_style_code"], bytearray(base64.b64decode(data["table"])), data["dims"])
+
+
+class TableStyle:
+    """
+    PlayerStyle whose draw_again is a DecisionTable lookup
+
+    The game score and leader buckets are fixed for a round, so at the start of each round the style
+    slices out the (hand size, round score) entries of its current game and leader buckets. Each decision
+    is then one index into that row.
+    """
+
+    def __init__(self, player_name, table:DecisionTable) -> None:
+        self.base_style = STYLES_BY_CODE[table.base_style_code](player_name)
+        self.player_name = player_name
+        self.table = table
+        self.style_code = table.style_code
+
+        (_, self.hand_width, num_hand), (_, self.round_width, self.num_round) = table.dims[:2]
+        self.max_hand, self.max_round = num_hand - 1, self.num_round - 1
+
+        self.round_num: int = -1
+        self.row: bytearray = bytearray()
+
+    def __setattr__(self, name, value) -> None:
+        # The base style makes the other decisions for the same player
+        object.__setattr__(self, name, value)
+        if name == "player":
+            self.base_style.player = value
+
+    def draw_again(self, game:Flip7Game) -> bool:
+        player = self.player
+        if game.round_num != self.round_num:
+            # A style plays a single game, so the round number alone tells when the row is stale
+            self.round_num = game.round_num
+            self.row = self.table.round_row(player, game)
+
+        # The bucketing of DecisionTable.index, written out for the two dims that change every turn
+        hand_bucket = len(player.hand) // self.hand_width
+        round_bucket = player.round_score // self.round_width
+        return self.row[
+            (hand_bucket if hand_bucket < self.max_hand else self.max_hand) * self.num_round
+            + (round_bucket if round_bucket < self.max_round else self.max_round)
+        ] != 0
+
+    def who_to_flip_three(self, game:Flip7Game) -> Player:
+        return self.base_style.who_to_flip_three(game)
+
+    def who_to_freeze(self, game:Flip7Game) -> Player:
+        return self.base_style.who_to_freeze(game)
+
+    def who_to_give_2chance(self, game:Flip7Game) -> Player | None:
+        return self.base_style.who_to_give_2chance(game)
+
+######################################################################################################
+# Compiling
+
+def bucket_value(width:int, bucket:int) -> int:
+    """Representative raw value of a bucket (its midpoint)"""
+    return bucket * width + width // 2
+
+def compile_style(style:PlayerStyle, style_code:str | None = None, dims:list = STATE_DIMS) -> DecisionTable:
+    """
+    Evaluate `style.draw_again` once for every state key and store the answers in a DecisionTable
+
+    Each state is built as a two player probe game (the player and the best opponent) holding the
+    bucket's midpoint scores. The compiled style only matches the original if its draw_again depends on
+    nothing but the state key, and on scores only up to the bucket width.
+    """
+    probe = Flip7Game(2, seed=0, seat_styles=[style, style], num_decks=1)
+    me, leader = probe.players
+    probe.leaders = [leader, me]
+
+    (_, hand_width, num_hand), (_, round_width, num_round), (_, game_width, num_game), (_, leader_width, num_leader) = dims
+    compiled = DecisionTable(style_code or f"{style.style_code}*", style.style_code, bytearray(math.prod([num_hand, num_round, num_game, num_leader])), dims)
+
+    for hand_bucket in range(num_hand):
+        hand_size = bucket_value(hand_width, hand_bucket)
+        me.hand = [NumberCard(str(value), value) for value in range(hand_size)]
+        for round_bucket in range(num_round):
+            me.round_score = bucket_value(round_width, round_bucket)
+            for game_bucket in range(num_game):
+                me.game_score = bucket_value(game_width, game_bucket)
+                for leader_bucket in range(num_leader):
+                    leader.game_score = bucket_value(leader_width, leader_bucket)
+                    compiled.table[compiled.index([hand_size, me.round_score, me.game_score, leader.game_score])] = bool(me.draw_again(probe))
+
+    return compiled
+
+def benchmark_draw_again(style:PlayerStyle | DecisionTable, num_calls:int = 200_000) -> float:
+    """Seconds taken by `num_calls` draw_again decisions of a style on a mid-round state"""
+    game = Flip7Game(2, seed=0, seat_styles=[style, style], num_decks=1)
+    game.start_round()
+    player = game.players[0]
+    player.hand = [NumberCard(str(value), value) for value in range(3)]
+    player.round_score = 15
+
+    draw_again = player.play_style.draw_again
+    start = perf_counter()
+    for _i in range(num_calls):
+        draw_again(game)
+    return perf_counter() - start
+
+def load_table(path:str | Path) -> DecisionTable:
+    """Load a saved DecisionTable and register its style code so its games can be replayed"""
+    table = DecisionTable.load(path)
+    STYLES_BY_CODE[table.style_code] = table
+
+    return table
@@ -0,0 +1,206 @@
+from typing import Callable
+from random import Random, getrandbits
+import logging
+import math
+
+from .cards import Card, NumberCard, MultModifierCard, Flip3ActionCard
+from .game import Flip7Game, Player, play_flip7, quiet_game_logs
+from .stats import RunningStats
+
+Z_95 = 1.96
+DEFENSIVE_FRACTION = 0.2
+
+######################################################################################################
+# Tilts
+#
+# A tilt gives the weight of drawing `card` for the player about to draw. Weights above 1 make a card
+# more likely than under a fair shuffle. Tilting only the few draws that lead to the event keeps the
+# likelihood ratio of the other draws at exactly 1.
+
+def holds_x2(player:Player) -> bool:
+    return any(isinstance(card, MultModifierCard) for card in player.modifier_hand)
+
+def is_duplicate(player:Player, card:Card) -> bool:
+    return isinstance(card, NumberCard) and card in player.hand
+
+def flip3_chain_tilt(game:Flip7Game, player:Player, card:Card) -> float:
+    """Favour a Flip 3 while the player still owes draws to an earlier Flip 3"""
+    if isinstance(card, Flip3ActionCard) and player.flip3_draws > 0:
+        return 8.0
+    return 1.0
+
+def flip7_tilt(game:Flip7Game, player:Player, card:Card) -> float:
+    """Avoid busting long hands"""
+    if len(player.hand) >= 5 and is_duplicate(player, card):
+        return 0.4
+    return 1.0
+
+def flip7_x2_tilt(game:Flip7Game, player:Player, card:Card) -> float:
+    """Favour the x2 for long hands, then avoid busting once it is held"""
+    if len(player.hand) < 3:
+        return 1.0
+    if holds_x2(player):
+        return 0.4 if is_duplicate(player, card) else 1.0
+    return 4.0 if isinstance(card, MultModifierCard) else 1.0
+
+def flip7_2chance_tilt(game:Flip7Game, player:Player, card:Card) -> float:
+    """Avoid busting long hands that already used their second chance"""
+    if player.used_second_chance and len(player.hand) >= 4 and is_duplicate(player, card):
+        return 0.4
+    return 1.0
+
+def no_tilt(game:Flip7Game, player:Player, card:Card) -> float:
+    return 1.0
+
+# Default tilt for each event counted in Flip7Game.events
+EVENT_TILTS = {
+    "flip7": flip7_tilt,
+    "flip7_x2": flip7_x2_tilt,
+    "flip7_2chance": flip7_2chance_tilt,
+    "flip3_chain": flip3_chain_tilt,
+}
+
+######################################################################################################
+# Tilted draws
+
+class TiltedFlip7Game(Flip7Game):
+    """
+    Flip7Game whose draws can favour some cards, keeping track of the likelihood ratio of the game
+
+    Drawing the top card of a uniformly shuffled deck is the same as drawing a uniformly random card
+    from the cards left in the deck. When `tilted`, each draw instead picks a card with probability
+    proportional to its weight under `tilt`. Either way `log_weight` accumulates log(P_uniform / P_tilted)
+    of every card actually drawn. Style decisions use their own generator and are never tilted, so they
+    cancel out of the ratio.
+    """
+
+    def __init__(self, num_players:int, tilt:Callable[[Flip7Game, Player, Card], float], tilted:bool = True, **kwargs):
+        self.tilt: Callable[[Flip7Game, Player, Card], float] = tilt
+        self.tilted: bool = tilted
+        self.log_weight: float = 0.0
+        self.drawing_player: Player | None = None
+        super().__init__(num_players, **kwargs)
+
+    def next_player(self) -> Player | None:
+        """Remember who is about to draw, for the tilt"""
+        self.drawing_player = super().next_player()
+        return self.drawing_player
+
+    def draw_card(self):
+        if not self.deck:
+            logging.info(f" - GAME {self.game_id.split("-")[0]} - ROUND {self.round_num}: Deck empty, reshuffling Discard pile (n={len(self.discard)})")
+            if not self.discard:
+                raise RuntimeError(f"every card of the {self.num_decks} deck shoe is in a player's hand; play with more decks")
+            self.deck, self.discard = self.discard, []
+
+        weights = [self.tilt(self, self.drawing_player, card) for card in self.deck]
+        total = sum(weights)
+
+        if self.tilted:
+            # Pick a card with probability weight / total
+            target = self.deck_rng.random() * total
+            index = 0
+            while index < len(weights) - 1 and target >= weights[index]:
+                target -= weights[index]
+                index += 1
+        else:
+            index = self.deck_rng.randrange(len(self.deck))
+
+        self.log_weight += math.log(total / (len(self.deck) * weights[index]))
+
+        self.deck[index], self.deck[-1] = self.deck[-1], self.deck[index]
+        return self.deck.pop()
+
+######################################################################################################
+# Estimation
+
+class RareEventEstimate:
+    """Streaming importance sampling estimate of the probability of an event per game"""
+
+    def __init__(self, event:str, min_count:int):
+        self.event: str = event
+        self.min_count: int = min_count
+        self.weighted = RunningStats() # indicator x likelihood ratio
+        self.hits: int = 0
+        self._sum_weights: float = 0.0
+        self._sum_sq_weights: float = 0.0
+
+    def push(self, hit:bool, weight:float) -> None:
+        self.weighted.push(weight if hit else 0.0)
+        if hit:
+            self.hits += 1
+            self._sum_weights += weight
+            self._sum_sq_weights += weight * weight
+
+    @property
+    def probability(self) -> float:
+        return self.weighted.mean
+
+    @property
+    def std_error(self) -> float:
+        return self.weighted.std / math.sqrt(max(self.weighted.count, 1))
+
+    @property
+    def effective_sample_size(self) -> float:
+        """Kish effective number of hits; small values mean a few games dominate the estimate"""
+        if self._sum_sq_weights == 0:
+            return 0.0
+        return self._sum_weights ** 2 / self._sum_sq_weights
+
+    @property
+    def variance_reduction(self) -> float:
+        """How many times more plain simulated games would be needed for the same standard error"""
+        p = self.probability
+        if self.weighted.variance == 0:
+            return math.inf
+        return p * (1 - p) / self.weighted.variance
+
+    def summary(self) -> str:
+        low = self.probability - Z_95 * self.std_error
+        high = self.probability + Z_95 * self.std_error
+        return (
+            f"P({self.event} >= {self.min_count} per game) = {self.probability:.3e} +/- {self.std_error:.1e}  "
+            f"95% CI [{low:.3e}, {high:.3e}]  games {self.weighted.count}  hits {self.hits}  "
+            f"ESS {self.effective_sample_size:.0f}  variance reduction x{self.variance_reduction:.1f}"
+        )
+
+def estimate_rare_event(
+    event:str,
+    num_games:int,
+    num_players:int = 5,
+    min_count:int = 1,
+    tilt:Callable[[Flip7Game, Player, Card], float] | None = None,
+    uniform_fraction:float = DEFENSIVE_FRACTION,
+    first_seed:int | None = None,
+    num_decks:int | None = None
+) -> RareEventEstimate:
+    """
+    Estimate the probability that a game has at least `min_count` of an event from Flip7Game.events
+
+    Games are drawn from a defensive mixture: a `uniform_fraction` of the games is played normally and
+    the rest with draws tilted by `tilt` (EVENT_TILTS[event] by default). Each game
+    counts with weight P_uniform / P_mixture, which keeps the estimate unbiased. Mixing in plain games
+    caps every weight at 1 / uniform_fraction, so a long game of slightly tilted draws cannot produce a
+    huge weight and swamp the estimate. Pass `no_tilt` for plain simulation.
+    """
+    if tilt is None:
+        tilt = EVENT_TILTS[event]
+    if first_seed is None:
+        first_seed = getrandbits(62)
+
+    estimate = RareEventEstimate(event, min_count)
+
+    logging.info(f" - RARE {event}: estimating over {num_games} games with {tilt.__name__}")
+
+    mixture_rng = Random(first_seed)
+    with quiet_game_logs():
+        for seed in range(first_seed, first_seed + num_games):
+            tilted = mixture_rng.random() >= uniform_fraction
+            game = TiltedFlip7Game(num_players, tilt, tilted=tilted, seed=seed, num_decks=num_decks)
+            play_flip7(record=False, game=game)
+
+            # P_uniform / (f P_uniform + (1 - f) P_tilted), with log_weight = log(P_uniform / P_tilted)
+            weight = 1 / (uniform_fraction + (1 - uniform_fraction) * math.exp(min(-game.log_weight, 700)))
+            estimate.push(game.events[event] >= min_count, weight)
+
+    return estimate
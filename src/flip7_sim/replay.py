@@ -0,0 +1,85 @@
+from random import getrandbits
+import sqlite3
+
+from .db import sql_create_tables
+from .game import Flip7Game, STYLES_BY_CODE, ENGINE_VERSION, play_flip7, quiet_game_logs
+
+TURN_COLUMNS = "player_id, turn_id, round_id, game_id, game_score, round_score, num_cards, hand, stay, busted, frozen, second_chance"
+
+def get_replay(game_id:str, con:sqlite3.Connection) -> tuple[int, list[str], int, int | None]:
+    """Returns the seed, the style code of each seat, the number of decks and the engine version for a recorded game"""
+    cursor = con.execute("SELECT seed, styles, num_decks, engine_version FROM replays WHERE game_id = :game_id", {"game_id": game_id})
+
+    row = cursor.fetchone()
+    if row is None:
+        raise KeyError(f"no replay recorded for game {game_id}")
+
+    seed, styles, num_decks, engine_version = row
+    return seed, styles.split(","), num_decks, engine_version
+
+def rebuild_game(game_id:str, con:sqlite3.Connection) -> Flip7Game:
+    """
+    Returns a fresh, unplayed Flip7Game identical to the recorded game
+
+    Raises ValueError if the game was recorded by another engine version, since its seed would not play
+    out the same way.
+    """
+    seed, style_codes, num_decks, engine_version = get_replay(game_id, con)
+
+    if engine_version != ENGINE_VERSION:
+        raise ValueError(
+            f"game {game_id} was recorded by engine version {engine_version or 'unknown'}, this is version {ENGINE_VERSION}; "
+            "its replay record can't be rebuilt"
+        )
+
+    seat_styles = [STYLES_BY_CODE[code] for code in style_codes]
+
+    return Flip7Game(len(seat_styles), seed=seed, game_id=game_id, seat_styles=seat_styles, num_decks=num_decks)
+
+def replay_game(game_id:str, con:sqlite3.Connection) -> sqlite3.Connection:
+    """
+    Replay a recorded game and return an in-memory database holding its full turn table
+
+    The game is played again from its seed, which reproduces the original game as long as it was recorded
+    by the same ENGINE_VERSION (see `rebuild_game`).
+    """
+    replay_con = sqlite3.connect(":memory:")
+    sql_create_tables(replay_con)
+
+    # The game was logged when it was first played; don't log it again
+    with quiet_game_logs():
+        play_flip7(con=replay_con, game=rebuild_game(game_id, con))
+
+    return replay_con
+
+######################################################################################################
+# Determinism checks
+
+def get_turns(game_id:str, con:sqlite3.Connection) -> list[tuple]:
+    query = f"SELECT {TURN_COLUMNS} FROM player_turns WHERE game_id = :game_id ORDER BY rowid"
+    return con.execute(query, {"game_id": game_id}).fetchall()
+
+def verify_replay(game_id:str, con:sqlite3.Connection) -> bool:
+    """True if replaying a game with stored turns rebuilds exactly the same turn table"""
+    return get_turns(game_id, replay_game(game_id, con)) == get_turns(game_id, con)
+
+def check_replays(num_games:int, num_players:int = 5, first_seed:int | None = None, num_decks:int | None = None) -> list[str]:
+    """
+    Play games with every turn stored, replay each from its record and return the ids of the games whose
+    replay differs. Run it after changing the game logic: any mismatch means ENGINE_VERSION must be bumped
+    or the change made the engine nondeterministic.
+    """
+    if first_seed is None:
+        first_seed = getrandbits(62)
+
+    con = sqlite3.connect(":memory:")
+    sql_create_tables(con)
+
+    mismatches = []
+    with quiet_game_logs():
+        for seed in range(first_seed, first_seed + num_games):
+            game = play_flip7(con=con, game=Flip7Game(num_players, seed=seed, num_decks=num_decks))
+            if not verify_replay(game.game_id, con):
+                mismatches.append(game.game_id)
+
+    return mismatches
@@ -0,0 +1,154 @@
+from random import randrange
+from uuid import uuid4
+import logging
+import math
+import sqlite3
+
+from .db import sql_connect_to_db, sql_delete_game, sql_write_aggregate_stats
+from .game import Flip7Game, play_flip7, quiet_game_logs
+from .telemetry import Telemetry
+
+SCORE_BIN_WIDTH = 10
+SCORE_NUM_BINS = 40 # scores of 400+ land in the last bin
+ROUNDS_NUM_BINS = 30 # games of 30+ rounds land in the last bin
+
+######################################################################################################
+# Streaming accumulators
+
+class RunningStats:
+    """Welford's online mean and variance. Uses constant memory no matter how many values are pushed"""
+
+    def __init__(self):
+        self.count: int = 0
+        self.mean: float = 0.0
+        self._m2: float = 0.0
+
+    def push(self, value:float) -> None:
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+
+    @property
+    def variance(self) -> float:
+        """Sample variance of the values pushed so far"""
+        if self.count < 2:
+            return 0.0
+        return self._m2 / (self.count - 1)
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self.variance)
+
+
+class Histogram:
+    """Fixed width histogram starting at 0. Values past the last bin are counted in the last bin"""
+
+    def __init__(self, bin_width:int, num_bins:int):
+        self.bin_width: int = bin_width
+        self.counts: list[int] = [0] * num_bins
+
+    def push(self, value:int) -> None:
+        index = min(max(value, 0) // self.bin_width, len(self.counts) - 1)
+        self.counts[index] += 1
+
+
+class SeatStats:
+    """Aggregates for one (style, seat) pair"""
+
+    def __init__(self):
+        self.score = RunningStats()
+        self.rounds = RunningStats()
+        self.score_hist = Histogram(SCORE_BIN_WIDTH, SCORE_NUM_BINS)
+        self.rounds_hist = Histogram(1, ROUNDS_NUM_BINS)
+        self.wins: int = 0
+        self.busts: int = 0
+        self.flip7s: int = 0
+
+
+class AggregateStats:
+    """Streaming summary of many games keyed by (style_code, seat)"""
+
+    def __init__(self):
+        self.num_games: int = 0
+        self.by_style_seat: dict[tuple[str, int], SeatStats] = {}
+
+    def add_game(self, game:Flip7Game) -> None:
+        """Fold a finished game into the aggregates"""
+        self.num_games += 1
+
+        for seat, player in enumerate(game.players, start=1):
+            key = (player.play_style.style_code, seat)
+            if key not in self.by_style_seat:
+                self.by_style_seat[key] = SeatStats()
+            seat_stats = self.by_style_seat[key]
+
+            seat_stats.score.push(player.game_score)
+            seat_stats.score_hist.push(player.game_score)
+            seat_stats.rounds.push(game.round_num)
+            seat_stats.rounds_hist.push(game.round_num)
+            seat_stats.busts += player.num_busts
+            seat_stats.flip7s += player.num_flip7s
+            if player is game.winner:
+                seat_stats.wins += 1
+
+    def summary(self) -> str:
+        """Return a printable table of the aggregates"""
+        lines = [f"{'style':>5} {'seat':>4} {'games':>7} {'win %':>6} {'score':>7} {'std':>6} {'rounds':>6} {'busts/g':>7} {'f7/g':>5}"]
+        for (style_code, seat), s in sorted(self.by_style_seat.items(), key=lambda item: item[0][1]):
+            games = s.score.count
+            lines.append(
+                f"{style_code:>5} {seat:>4} {games:>7} {100 * s.wins / games:>6.1f} {s.score.mean:>7.1f} {s.score.std:>6.1f} "
+                f"{s.rounds.mean:>6.2f} {s.busts / games:>7.2f} {s.flip7s / games:>5.2f}"
+            )
+        return "\n".join(lines)
+
+######################################################################################################
+# Aggregate run mode
+
+def play_aggregate(num_games:int, num_players:int = 5, reservoir_size:int = 10, con:sqlite3.Connection | None = None, store_turns:bool = True, num_decks:int | None = None, telemetry:Telemetry | None = None) -> AggregateStats:
+    """
+    Play `num_games` games keeping only streaming aggregates per style and seat.
+
+    Full turn traces are kept for a uniform reservoir sample of `reservoir_size` games (Algorithm R).
+    Whether a game enters the reservoir does not depend on its outcome, so the decision is made before
+    the game is played and only sampled games are written turn by turn. A game pushed out of the
+    reservoir is deleted from the database, so at most `reservoir_size` traces are stored at any time.
+    With `store_turns` False the sampled games are kept as replay records only. Likewise only sampled
+    games are written to the log, so the log grows with the number of games that ever enter the
+    reservoir (about reservoir_size * (1 + ln(num_games / reservoir_size))) rather than with num_games.
+    """
+    if con is None:
+        con = sql_connect_to_db()
+
+    run_id = str(uuid4())
+    stats = AggregateStats()
+    reservoir: list[str] = []
+
+    logging.info(f" - RUN {run_id.split("-")[0]}: BEGIN AGGREGATE RUN ({num_games} games, reservoir {reservoir_size})")
+
+    for i in range(num_games):
+        if i < reservoir_size:
+            slot = i
+        else:
+            slot = randrange(i + 1)
+        keep = slot < reservoir_size
+
+        if keep:
+            game = play_flip7(num_players=num_players, con=con, store_turns=store_turns, num_decks=num_decks, telemetry=telemetry)
+        else:
+            with quiet_game_logs():
+                game = play_flip7(num_players=num_players, record=False, num_decks=num_decks, telemetry=telemetry)
+        stats.add_game(game)
+
+        if keep:
+            if slot < len(reservoir):
+                sql_delete_game(reservoir[slot], con)
+                reservoir[slot] = game.game_id
+            else:
+                reservoir.append(game.game_id)
+
+    sql_write_aggregate_stats(run_id, stats, con)
+    logging.info(f" - RUN {run_id.split("-")[0]}: RUN COMPLETE")
+
+    return stats
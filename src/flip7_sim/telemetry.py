@@ -0,0 +1,329 @@
+"""
+Live telemetry of running simulations through a memory mapped file
+
+The file holds a header and a fixed number of worker slots. A writer claims a free slot (never used,
+or left by a process that has exited) under a file lock when it starts; after that the slot is written
+by that process only, so writers never lock again. Turn timings are accumulated in plain Python ints
+and published to the slot once per game with ordinary memory writes; no system call is made per turn.
+Readers (`flip7 monitor`) use the slot's sequence number (odd while a write is in progress) to retry
+torn reads, and skip slots whose process has exited.
+
+Layout (little endian):
+
+    header   magic, version, num_slots, ring_size, num_styles, style codes
+    slot     pid, seq, games, turns, rounds,
+             (seats, wins) per style, (total ns, count) per phase,
+             ring head, ring of the most recent games
+"""
+from pathlib import Path
+from time import monotonic, perf_counter_ns, time_ns, sleep
+import fcntl
+import mmap
+import os
+import struct
+
+from .game import Flip7Game, STYLES_BY_CODE
+
+TELEMETRY_PATH = "flip7-telemetry.bin"
+
+MAGIC = b"F7TM"
+VERSION = 1
+NUM_SLOTS = 64
+RING_SIZE = 64
+MAX_STYLES = 8 # the last style slot counts every style not known when the file was created
+PHASES = ["decide", "draw", "resolve", "record"]
+
+HEADER = struct.Struct(f"<4sIIII{MAX_STYLES * 8}s")
+HEADER_SIZE = 128
+SLOT_HEAD = struct.Struct("<QQQQQ") # pid, seq, games, turns, rounds
+STYLE_COUNTS = struct.Struct(f"<{2 * MAX_STYLES}Q")
+PHASE_COUNTS = struct.Struct(f"<{2 * len(PHASES)}Q")
+RING_HEAD = struct.Struct("<Q")
+RING_ENTRY = struct.Struct("<QQIIII") # end time ns, duration ns, winner style, winner score, rounds, players
+
+STYLES_OFFSET = SLOT_HEAD.size
+PHASES_OFFSET = STYLES_OFFSET + STYLE_COUNTS.size
+RING_HEAD_OFFSET = PHASES_OFFSET + PHASE_COUNTS.size
+RING_OFFSET = RING_HEAD_OFFSET + RING_HEAD.size
+SLOT_SIZE = RING_OFFSET + RING_SIZE * RING_ENTRY.size
+FILE_SIZE = HEADER_SIZE + NUM_SLOTS * SLOT_SIZE
+
+CREATE_TIMEOUT_SECONDS = 5.0 # how long to wait for another process to finish creating the file
+READ_RETRIES = 100
+
+######################################################################################################
+# File setup
+
+def _open_telemetry_file(path:str | Path) -> mmap.mmap:
+    """Map the telemetry file, creating it with its header if it does not exist yet"""
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o644)
+    except FileExistsError:
+        fd = os.open(path, os.O_RDWR)
+        # Wait for the creator to finish writing the header
+        deadline = monotonic() + CREATE_TIMEOUT_SECONDS
+        while os.fstat(fd).st_size < FILE_SIZE:
+            if monotonic() > deadline:
+                os.close(fd)
+                raise ValueError(f"{path} is not a complete telemetry file; delete it if no run is creating it")
+            sleep(0.01)
+    else:
+        style_codes = list(STYLES_BY_CODE)[:MAX_STYLES - 1] + ["other"]
+        packed_codes = b"".join(code.encode()[:8].ljust(8, b"\0") for code in style_codes)
+        header = HEADER.pack(MAGIC, VERSION, NUM_SLOTS, RING_SIZE, len(style_codes), packed_codes)
+
+        os.write(fd, header.ljust(HEADER_SIZE, b"\0"))
+        os.ftruncate(fd, FILE_SIZE)
+
+    buffer = mmap.mmap(fd, FILE_SIZE)
+    os.close(fd)
+
+    magic, version, num_slots, ring_size, _num_styles, _packed_codes = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        buffer.close()
+        raise ValueError(f"{path} is not a flip7 telemetry file")
+    if (version, num_slots, ring_size) != (VERSION, NUM_SLOTS, RING_SIZE):
+        buffer.close()
+        raise ValueError(f"{path} has telemetry version {version}, expected {VERSION}; delete it to start a new one")
+    return buffer
+
+def _pid_alive(pid:int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Alive, but owned by another user
+        return True
+    return True
+
+def _claim_slot(path:str | Path, buffer:mmap.mmap) -> int:
+    """Give this process a slot that was never used or whose process has exited, and reset it"""
+    fd = os.open(path, os.O_RDWR)
+    try:
+        # Only one process picks a slot at a time
+        fcntl.flock(fd, fcntl.LOCK_EX)
+
+        for slot in range(NUM_SLOTS):
+            offset = HEADER_SIZE + slot * SLOT_SIZE
+            pid = SLOT_HEAD.unpack_from(buffer, offset)[0]
+            if pid == 0 or not _pid_alive(pid):
+                buffer[offset:offset + SLOT_SIZE] = bytes(SLOT_SIZE)
+                SLOT_HEAD.pack_into(buffer, offset, os.getpid(), 0, 0, 0, 0)
+                return slot
+    finally:
+        os.close(fd)
+
+    raise RuntimeError(f"all {NUM_SLOTS} slots of {path} are held by running processes")
+
+def _read_style_codes(buffer:mmap.mmap) -> list[str]:
+    _magic, _version, _num_slots, _ring_size, num_styles, packed_codes = HEADER.unpack_from(buffer, 0)
+    return [packed_codes[i * 8:(i + 1) * 8].rstrip(b"\0").decode() for i in range(num_styles)]
+
+######################################################################################################
+# Writer
+
+class Telemetry:
+    """
+    Writes the counters of one worker to its slot of the telemetry file
+
+    The game loop calls `turn()` with the time spent in each phase and `end_game()` once per game.
+    The slot is claimed when the Telemetry is created and is free again once the process exits.
+    """
+
+    def __init__(self, path:str | Path = TELEMETRY_PATH):
+        self.buffer: mmap.mmap = _open_telemetry_file(path)
+        self.slot: int = _claim_slot(path, self.buffer)
+        self.offset: int = HEADER_SIZE + self.slot * SLOT_SIZE
+        self.style_index: dict[str, int] = {code: i for i, code in enumerate(_read_style_codes(self.buffer)[:-1])}
+
+        # Local copies of the slot counters; the slot is rewritten from these after every game
+        self.seq: int = 0
+        self.games: int = 0
+        self.turns: int = 0
+        self.rounds: int = 0
+        self.style_counts: list[int] = [0] * (2 * MAX_STYLES)
+        self.phase_counts: list[int] = [0] * (2 * len(PHASES))
+
+    def turn(self, decide_ns:int, draw_ns:int, resolve_ns:int, record_ns:int) -> None:
+        """Add the time spent in each phase of a turn. A turn where the player stays has no draw or resolve"""
+        counts = self.phase_counts
+        counts[0] += decide_ns
+        counts[1] += 1
+        if draw_ns:
+            counts[2] += draw_ns
+            counts[3] += 1
+            counts[4] += resolve_ns
+            counts[5] += 1
+        counts[6] += record_ns
+        counts[7] += 1
+        self.turns += 1
+
+    def end_game(self, game:Flip7Game, duration_ns:int) -> None:
+        """Publish the counters and add the game to the ring of recent games"""
+        self.games += 1
+        self.rounds += game.round_num
+
+        # Styles missing from the header (e.g. compiled tables) count under its last code, "other"
+        other = len(self.style_index)
+        for player in game.players:
+            index = self.style_index.get(player.play_style.style_code, other)
+            self.style_counts[2 * index] += 1
+            if player is game.winner:
+                self.style_counts[2 * index + 1] += 1
+        winner_index = self.style_index.get(game.winner.play_style.style_code, other)
+
+        buffer, offset = self.buffer, self.offset
+
+        # Odd sequence number while the slot is being written
+        self.seq += 1
+        struct.pack_into("<Q", buffer, offset + 8, self.seq)
+
+        SLOT_HEAD.pack_into(buffer, offset, os.getpid(), self.seq, self.games, self.turns, self.rounds)
+        STYLE_COUNTS.pack_into(buffer, offset + STYLES_OFFSET, *self.style_counts)
+        PHASE_COUNTS.pack_into(buffer, offset + PHASES_OFFSET, *self.phase_counts)
+        RING_ENTRY.pack_into(
+            buffer,
+            offset + RING_OFFSET + ((self.games - 1) % RING_SIZE) * RING_ENTRY.size,
+            time_ns(), duration_ns, winner_index, game.winner.game_score, game.round_num, len(game.players)
+        )
+        RING_HEAD.pack_into(buffer, offset + RING_HEAD_OFFSET, self.games)
+
+        self.seq += 1
+        struct.pack_into("<Q", buffer, offset + 8, self.seq)
+
+######################################################################################################
+# Reader
+
+def read_slot(buffer:mmap.mmap, slot:int) -> dict | None:
+    """
+    Consistent snapshot of a slot, or None if the slot is free, its process has exited, or it could not
+    be read without a write in between after READ_RETRIES tries
+    """
+    offset = HEADER_SIZE + slot * SLOT_SIZE
+
+    pid = SLOT_HEAD.unpack_from(buffer, offset)[0]
+    if pid == 0 or not _pid_alive(pid):
+        return None
+
+    for _i in range(READ_RETRIES):
+        seq_before = struct.unpack_from("<Q", buffer, offset + 8)[0]
+        if seq_before % 2:
+            sleep(0)
+            continue
+
+        pid, _seq, games, turns, rounds = SLOT_HEAD.unpack_from(buffer, offset)
+        style_counts = STYLE_COUNTS.unpack_from(buffer, offset + STYLES_OFFSET)
+        phase_counts = PHASE_COUNTS.unpack_from(buffer, offset + PHASES_OFFSET)
+        ring_head = RING_HEAD.unpack_from(buffer, offset + RING_HEAD_OFFSET)[0]
+        ring = [
+            RING_ENTRY.unpack_from(buffer, offset + RING_OFFSET + i * RING_ENTRY.size)
+            for i in range(min(ring_head, RING_SIZE))
+        ]
+
+        if struct.unpack_from("<Q", buffer, offset + 8)[0] == seq_before:
+            break
+    else:
+        return None
+
+    return {
+        "pid": pid,
+        "games": games,
+        "turns": turns,
+        "rounds": rounds,
+        "style_counts": style_counts,
+        "phase_counts": phase_counts,
+        "recent": ring,
+    }
+
+def read_totals(buffer:mmap.mmap) -> dict:
+    """Sum the counters of every live slot. `slots` keeps each slot's snapshot by (slot, pid)"""
+    totals = {
+        "workers": 0,
+        "games": 0,
+        "turns": 0,
+        "rounds": 0,
+        "style_counts": [0] * (2 * MAX_STYLES),
+        "phase_counts": [0] * (2 * len(PHASES)),
+        "recent": [],
+        "slots": {},
+    }
+    for slot in range(NUM_SLOTS):
+        snapshot = read_slot(buffer, slot)
+        if snapshot is None:
+            continue
+
+        totals["workers"] += 1
+        totals["slots"][(slot, snapshot["pid"])] = snapshot
+        for key in ["games", "turns", "rounds"]:
+            totals[key] += snapshot[key]
+        for key in ["style_counts", "phase_counts"]:
+            totals[key] = [a + b for a, b in zip(totals[key], snapshot[key])]
+        totals["recent"].extend(snapshot["recent"])
+
+    totals["recent"].sort(reverse=True)
+    return totals
+
+def interval_counts(previous:dict, current:dict) -> dict:
+    """
+    Games, turns and phase counts added between two snapshots of the totals
+
+    Only slots held by the same process in both snapshots count, so workers starting or exiting in
+    between do not show up as a jump in the rates.
+    """
+    delta = {"games": 0, "turns": 0, "phase_counts": [0] * (2 * len(PHASES))}
+    for key in current["slots"].keys() & previous["slots"].keys():
+        before, after = previous["slots"][key], current["slots"][key]
+        delta["games"] += after["games"] - before["games"]
+        delta["turns"] += after["turns"] - before["turns"]
+        delta["phase_counts"] = [d + a - b for d, a, b in zip(delta["phase_counts"], after["phase_counts"], before["phase_counts"])]
+    return delta
+
+def format_monitor(previous:dict, current:dict, seconds:float, style_codes:list[str], num_recent:int = 5) -> str:
+    """Render the change between two snapshots of the totals"""
+    delta = interval_counts(previous, current)
+    lines = [
+        f"workers {current['workers']}   games {current['games']}   turns {current['turns']}   "
+        f"{delta['games'] / seconds:.1f} games/s   {delta['turns'] / seconds:.0f} turns/s",
+        "",
+        f"{'style':>6} {'seats':>9} {'win %':>6}",
+    ]
+    for i, code in enumerate(style_codes):
+        seats, wins = current["style_counts"][2 * i], current["style_counts"][2 * i + 1]
+        if seats:
+            lines.append(f"{code:>6} {seats:>9} {100 * wins / seats:>6.1f}")
+
+    lines += ["", f"{'phase':>8} {'us/call':>8}   (over the last {seconds:.1f}s)"]
+    for i, phase in enumerate(PHASES):
+        total_ns, calls = delta["phase_counts"][2 * i], delta["phase_counts"][2 * i + 1]
+        lines.append(f"{phase:>8} {total_ns / calls / 1000 if calls else 0:>8.1f}")
+
+    lines += ["", "recent games:  winner  score  rounds  players  ms"]
+    for _end_ns, duration_ns, winner_index, score, rounds, players in current["recent"][:num_recent]:
+        winner = style_codes[min(winner_index, len(style_codes) - 1)]
+        lines.append(f"{winner:>21} {score:>6} {rounds:>7} {players:>8} {duration_ns / 1e6:>4.1f}")
+
+    return "\n".join(lines)
+
+def monitor(path:str | Path = TELEMETRY_PATH, interval:float = 1.0, once:bool = False) -> None:
+    """Show live totals of every worker writing to the telemetry file until interrupted"""
+    buffer = _open_telemetry_file(path)
+    style_codes = _read_style_codes(buffer)
+
+    previous = read_totals(buffer)
+    previous_time = perf_counter_ns()
+    try:
+        while True:
+            sleep(interval)
+            current = read_totals(buffer)
+            now = perf_counter_ns()
+
+            screen = format_monitor(previous, current, (now - previous_time) / 1e9, style_codes)
+            if once:
+                print(screen)
+                break
+            print("\033[H\033[J" + screen, flush=True)
+
+            previous, previous_time = current, now
+    except KeyboardInterrupt:
+        pass
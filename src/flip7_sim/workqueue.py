@@ -0,0 +1,315 @@
+"""
+File based work queue for splitting a large run across processes or machines sharing a directory
+
+Queue layout:
+
+    <root>/queue.json               run config written by `init_queue`
+    <root>/leases/<shard>.lease     owner and expiry of a shard being worked on
+    <root>/shards/<shard>.sqlite3   output of a shard, written only by the lease holder
+    <root>/done/<shard>             marker written once every game of the shard is checkpointed
+
+A shard is a range of game seeds. Leases are claimed with an exclusive create and expire unless the
+holder renews them, so a shard whose worker was killed is picked up by another worker. Every finished
+game is checkpointed in the shard database and the new owner resumes after the last checkpoint.
+Lease expiry uses wall clock time, so machines sharing the directory should keep their clocks in sync.
+"""
+from multiprocessing import Process
+from pathlib import Path
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+
+from .db import sql_connect_to_db, sql_delete_game, sql_write_checkpoint
+from .game import Flip7Game, play_flip7, quiet_game_logs
+from .telemetry import Telemetry
+
+LEASE_SECONDS = 60
+POLL_SECONDS = 5
+MERGED_TABLES = ["games", "players", "player_turns", "replays"]
+
+######################################################################################################
+# Queue setup and status
+
+def init_queue(root:str | Path, num_games:int, shard_size:int = 1000, num_players:int = 5, first_seed:int = 0, store_turns:bool = False, num_decks:int | None = None) -> None:
+    """Create the queue directory and its config. Game i of the run is played from seed first_seed + i"""
+    root = Path(root)
+    for sub_dir in ["leases", "shards", "done"]:
+        (root / sub_dir).mkdir(parents=True, exist_ok=True)
+
+    config = {
+        "num_games": num_games,
+        "shard_size": shard_size,
+        "num_players": num_players,
+        "first_seed": first_seed,
+        "store_turns": store_turns,
+        "num_decks": num_decks,
+    }
+    (root / "queue.json").write_text(json.dumps(config, indent=2))
+
+def read_config(root:str | Path) -> dict:
+    return json.loads((Path(root) / "queue.json").read_text())
+
+def shard_ids(config:dict) -> list[str]:
+    num_shards = -(-config["num_games"] // config["shard_size"])
+    return [f"shard_{i:05d}" for i in range(num_shards)]
+
+def shard_seeds(config:dict, shard_id:str) -> range:
+    """Seeds of the games in a shard"""
+    index = int(shard_id.split("_")[1])
+    start = index * config["shard_size"]
+    stop = min(start + config["shard_size"], config["num_games"])
+    return range(config["first_seed"] + start, config["first_seed"] + stop)
+
+def queue_status(root:str | Path) -> dict[str, int]:
+    """Count the done, leased and pending shards"""
+    root = Path(root)
+    status = {"done": 0, "leased": 0, "pending": 0}
+
+    for shard_id in shard_ids(read_config(root)):
+        if (root / "done" / shard_id).exists():
+            status["done"] += 1
+        elif _lease_is_live(_read_lease(_lease_path(root, shard_id))):
+            status["leased"] += 1
+        else:
+            status["pending"] += 1
+
+    return status
+
+######################################################################################################
+# Leases
+
+def _lease_path(root:Path, shard_id:str) -> Path:
+    return root / "leases" / f"{shard_id}.lease"
+
+def _read_lease(path:Path) -> dict | None:
+    """Returns the lease, or None if there is no lease or it has not been fully written yet"""
+    try:
+        return json.loads(path.read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def _lease_is_live(lease:dict | None) -> bool:
+    return lease is not None and lease["expires"] > time.time()
+
+def _lease_data(worker_id:str, lease_seconds:float) -> str:
+    return json.dumps({"worker": worker_id, "expires": time.time() + lease_seconds})
+
+def _create_lease(path:Path, worker_id:str, lease_seconds:float) -> bool:
+    """Atomically create the lease file. Returns False if it already exists"""
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+
+    with os.fdopen(fd, "w") as f:
+        f.write(_lease_data(worker_id, lease_seconds))
+    return True
+
+def try_claim_shard(root:Path, shard_id:str, worker_id:str, lease_seconds:float = LEASE_SECONDS) -> bool:
+    """Try to take the lease on a shard, reclaiming it if the previous holder's lease expired"""
+    if (root / "done" / shard_id).exists():
+        return False
+
+    path = _lease_path(root, shard_id)
+    if _create_lease(path, worker_id, lease_seconds):
+        return True
+
+    lease = _read_lease(path)
+    if lease is None:
+        # Half written lease; only reclaim it once its creator has clearly died
+        try:
+            if path.stat().st_mtime + lease_seconds > time.time():
+                return False
+        except FileNotFoundError:
+            pass
+    elif _lease_is_live(lease):
+        return False
+
+    # Move the expired lease aside. Only one worker can win the rename
+    stale_path = path.with_name(f"{path.name}.{worker_id}.stale")
+    try:
+        os.rename(path, stale_path)
+    except FileNotFoundError:
+        return False
+
+    if _read_lease(stale_path) != lease:
+        # Someone reclaimed the shard between our read and our rename; give the lease back. If a third
+        # worker created a lease in the meantime, that lease wins and the worker we took the lease from
+        # stops before its next game (see `holds_lease`)
+        try:
+            os.link(stale_path, path)
+        except FileExistsError:
+            pass
+        os.remove(stale_path)
+        return False
+
+    os.remove(stale_path)
+    logging.info(f" - QUEUE - WORKER {worker_id}: reclaimed expired lease on {shard_id}")
+    return _create_lease(path, worker_id, lease_seconds)
+
+def holds_lease(root:Path, shard_id:str, worker_id:str) -> bool:
+    """True if the lease file of the shard is ours"""
+    lease = _read_lease(_lease_path(root, shard_id))
+    return lease is not None and lease["worker"] == worker_id
+
+def renew_lease(root:Path, shard_id:str, worker_id:str, lease_seconds:float = LEASE_SECONDS) -> bool:
+    """Extend our lease on a shard. Returns False if the lease was lost to another worker"""
+    path = _lease_path(root, shard_id)
+
+    lease = _read_lease(path)
+    if lease is None or lease["worker"] != worker_id:
+        return False
+
+    tmp_path = path.with_name(f"{path.name}.{worker_id}.tmp")
+    tmp_path.write_text(_lease_data(worker_id, lease_seconds))
+    os.replace(tmp_path, path)
+    return True
+
+def release_lease(root:Path, shard_id:str, worker_id:str) -> None:
+    path = _lease_path(root, shard_id)
+
+    lease = _read_lease(path)
+    if lease is not None and lease["worker"] == worker_id:
+        path.unlink(missing_ok=True)
+
+######################################################################################################
+# Workers
+
+def work_shard(root:Path, config:dict, shard_id:str, worker_id:str, lease_seconds:float = LEASE_SECONDS, telemetry:Telemetry | None = None) -> bool:
+    """
+    Play every game of a shard that is not yet checkpointed. Returns False if the lease was lost
+
+    The lease is checked before every game, so a worker whose lease was taken over stops within one game.
+    Should two workers still play the same seed, the unique seed of `checkpoints` rejects the second
+    checkpoint and that worker drops its copy of the game and stops.
+    """
+    con = sql_connect_to_db(str(root / "shards" / f"{shard_id}.sqlite3"))
+
+    # Drop the partial game of a killed worker, then resume after the last checkpoint
+    unfinished = con.execute("SELECT game_id FROM games WHERE game_id NOT IN (SELECT game_id FROM checkpoints)").fetchall()
+    for (game_id,) in unfinished:
+        sql_delete_game(game_id, con)
+    done_seeds = {seed for (seed,) in con.execute("SELECT seed FROM checkpoints")}
+
+    logging.info(f" - QUEUE - WORKER {worker_id}: working {shard_id} ({len(done_seeds)} games already checkpointed)")
+
+    renew_at = time.time() + lease_seconds / 2
+    for seed in shard_seeds(config, shard_id):
+        if seed in done_seeds:
+            continue
+
+        if time.time() > renew_at:
+            still_leased = renew_lease(root, shard_id, worker_id, lease_seconds)
+            renew_at = time.time() + lease_seconds / 2
+        else:
+            still_leased = holds_lease(root, shard_id, worker_id)
+        if not still_leased:
+            logging.warning(f" - QUEUE - WORKER {worker_id}: lost lease on {shard_id}")
+            con.close()
+            return False
+
+        # Only the queue's own lease and progress lines are logged; a game's turns would dwarf them
+        game = Flip7Game(config["num_players"], seed=seed, num_decks=config.get("num_decks"))
+        with quiet_game_logs():
+            play_flip7(con=con, store_turns=config["store_turns"], game=game, telemetry=telemetry)
+        try:
+            sql_write_checkpoint(shard_id, game, con)
+        except sqlite3.IntegrityError:
+            logging.warning(f" - QUEUE - WORKER {worker_id}: seed {seed} of {shard_id} was already checkpointed by another worker")
+            sql_delete_game(game.game_id, con)
+            con.close()
+            return False
+
+    con.close()
+    (root / "done" / shard_id).touch()
+    release_lease(root, shard_id, worker_id)
+    logging.info(f" - QUEUE - WORKER {worker_id}: finished {shard_id}")
+
+    return True
+
+def run_worker(
+    root:str | Path,
+    worker_id:str | None = None,
+    lease_seconds:float = LEASE_SECONDS,
+    poll_seconds:float = POLL_SECONDS,
+    telemetry_path:str | None = None
+) -> None:
+    """
+    Claim and work shards until every shard is done
+
+    While the remaining shards are all leased by other workers, wait for them to finish or for their
+    leases to expire. With a `telemetry_path` the worker publishes its progress to a free slot of that
+    telemetry file.
+    """
+    root = Path(root)
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    config = read_config(root)
+    telemetry = Telemetry(telemetry_path) if telemetry_path else None
+
+    while True:
+        remaining = [shard_id for shard_id in shard_ids(config) if not (root / "done" / shard_id).exists()]
+        if not remaining:
+            break
+
+        claimed = False
+        for shard_id in remaining:
+            if try_claim_shard(root, shard_id, worker_id, lease_seconds):
+                claimed = True
+                work_shard(root, config, shard_id, worker_id, lease_seconds, telemetry)
+
+        if not claimed:
+            time.sleep(poll_seconds)
+
+def run_workers(root:str | Path, num_workers:int, lease_seconds:float = LEASE_SECONDS, telemetry_path:str | None = None) -> None:
+    """Run several workers as separate processes on this machine"""
+    processes = [
+        Process(
+            target=run_worker,
+            args=(root,),
+            kwargs={"lease_seconds": lease_seconds, "telemetry_path": telemetry_path}
+        )
+        for _i in range(num_workers)
+    ]
+
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+######################################################################################################
+# Merge
+
+def merge_shards(root:str | Path, db_path:str) -> int:
+    """
+    Merge every checkpointed game of every shard into one database. Returns the number of games merged
+
+    Games already present in the output database are skipped, so merging again after more shards
+    finish only adds the new games. A seed checkpointed more than once in a shard is merged once.
+    """
+    root = Path(root)
+    con = sql_connect_to_db(db_path)
+    num_merged = 0
+
+    for shard_path in sorted((root / "shards").glob("*.sqlite3")):
+        if not (root / "done" / shard_path.stem).exists():
+            logging.warning(f" - QUEUE: {shard_path.stem} is not finished; merging its checkpointed games only")
+
+        con.execute("ATTACH DATABASE ? AS shard", (str(shard_path),))
+        new_games = (
+            "SELECT game_id FROM shard.checkpoints "
+            "WHERE rowid IN (SELECT MIN(rowid) FROM shard.checkpoints GROUP BY seed) "
+            "AND game_id NOT IN (SELECT game_id FROM main.games)"
+        )
+        num_merged += con.execute(f"SELECT COUNT(*) FROM ({new_games})").fetchone()[0]
+
+        # games goes last since it is used to find the games that are not merged yet
+        for table in MERGED_TABLES[::-1]:
+            con.execute(f"INSERT INTO main.{table} SELECT * FROM shard.{table} WHERE game_id IN ({new_games})")
+        con.commit()
+        con.execute("DETACH DATABASE shard")
+
+    con.close()
+    return num_merged